@@ -4,19 +4,24 @@ M357_MAP.py - Sistema mejorado con geocodificación exhaustiva y detección de e
 """
 
 import feedparser
-import json
 import logging
 import os
 import re
-from typing import List, Optional, Tuple
+import sqlite3
+from collections import OrderedDict
+from itertools import chain
+from typing import Iterable, List, Optional, Tuple
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 from geojson import FeatureCollection, Feature, Point
 from transformers import pipeline
 import threading
+import time
 
 ############################################################################
 # ============================ CONFIGURACIÓN ===============================
@@ -68,16 +73,38 @@ RSS_FEEDS = [
 ]
 
 OUTPUT_FILE = "masonic_alerts.geojson"
+FEED_WORKERS = 8  # Feeds descargados en paralelo
+FEED_STATE_FILE = "feed_state.json"  # ETag/Last-Modified de cada feed entre ejecuciones
+
+# Sesión HTTP compartida: todos los feeds reutilizan conexiones keep-alive con el mismo host
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=FEED_WORKERS))
+
+GEOCACHE_DB = "geocode_cache.sqlite"
+GEOCACHE_COMMIT_EVERY = 100  # Escrituras por transacción en la caché de geocodificación
+GEOCACHE_MISS_TTL = 30 * 24 * 3600  # Segundos que se recuerda una consulta sin resultado
 
 GEOLOCATION_CONFIG = {
     'nominatim': {'user_agent': 'masonic_geo_v1', 'timeout': 15, 'rate_limit': 1.0}
 }
 
+# Palabra de un topónimo: en mayúsculas ("UK", "CAROLINA") o capitalizada, con
+# mayúsculas internas opcionales ("McAllen")
+LOCATION_WORD = r"(?:[A-ZÀ-ÖØ-Þ]{2,}|[A-ZÀ-ÖØ-Þ][a-zß-öø-ÿ'-]+(?:[A-ZÀ-ÖØ-Þ][a-zß-öø-ÿ'-]+)*)"
+# Preposición sin distinguir mayúsculas, artículo opcional en minúscula ("in the United
+# States", "en la Ciudad de México"; "La Paz" conserva el suyo) y 1 a 4 palabras (admite
+# conectores como "de" o "la"): sin IGNORECASE la captura no se extiende al resto de la
+# frase y Nominatim recibe menos consultas basura
 LOCATION_REGEX = re.compile(
-    r"\b(?:en\s+|in\s+|at\s+)([A-ZÀ-ÖØ-öø-ÿ][a-zÀ-ÖØ-öø-ÿ' -]+)",
-    re.IGNORECASE | re.UNICODE
+    r"\b(?i:en|in|at)\s+(?:(?:the|la|el|los|las|le|les)\s+)?"
+    rf"({LOCATION_WORD}(?:[ -](?:(?:de|del|la|los|las)\s+)?{LOCATION_WORD}){{0,3}})"
 )
 
+HTML_TAG_REGEX = re.compile(r"<[^>]+>")
+
+EMOTION_BATCH_SIZE = 16  # Textos por pasada del clasificador de emociones
+EMOTION_LABELS = ("joy", "sadness", "surprise", "fear")  # Emociones publicadas en cada Feature
+
 # Inicialización del modelo de emociones
 emotion_classifier = pipeline("text-classification", model="j-hartmann/emotion-english-distilroberta-base", return_all_scores=True)
 
@@ -86,18 +113,126 @@ emotion_classifier = pipeline("text-classification", model="j-hartmann/emotion-e
 ############################################################################
 
 class GeoCache:
-    """Caché simple para almacenar resultados de geocodificación y optimizar el rendimiento."""
-    def __init__(self, max_size: int = 500):
-        self.cache = {}
+    """Caché de geocodificación en memoria respaldada por SQLite entre ejecuciones."""
+    def __init__(self, max_size: int = 500, db_path: str = GEOCACHE_DB,
+                 commit_every: int = GEOCACHE_COMMIT_EVERY, miss_ttl: int = GEOCACHE_MISS_TTL):
+        self.cache = OrderedDict()  # Capa LRU en memoria delante de SQLite
+        self.mem_lock = threading.Lock()
+        self.misses = set()  # Consultas sin resultado ya comprobadas en esta ejecución
+        self.miss_ttl = miss_ttl
         self.max_size = max_size
+        self.commit_every = commit_every
+        self.pending_writes = []  # Filas (query, lon, lat) aún no escritas en SQLite
+        self.pending_misses = []  # Filas (query, ts) aún no escritas en SQLite
+        self.db_path = db_path
+        # Una única conexión de escritura protegida por lock y lectores por hilo
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+        self.readers = []
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL + synchronous=NORMAL: muchas escrituras comparten un único fsync
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            CREATE TABLE IF NOT EXISTS locations (
+                query TEXT PRIMARY KEY,
+                lon REAL NOT NULL,
+                lat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS misses (
+                query TEXT PRIMARY KEY,
+                ts INTEGER NOT NULL
+            );
+        """)
 
     def get(self, key: str) -> Optional[Tuple[float, float]]:
-        return self.cache.get(key)
+        with self.mem_lock:
+            cached = self.cache.get(key)
+            if cached:
+                self.cache.move_to_end(key)  # Marcar como usado recientemente
+                return cached
+        row = self._reader().execute(
+            "SELECT lon, lat FROM locations WHERE query = ?", (key,)
+        ).fetchone()
+        if row:
+            self._remember(key, (row[0], row[1]))
+            return (row[0], row[1])
+        return None
 
     def set(self, key: str, value: Tuple[float, float]):
-        if len(self.cache) >= self.max_size:
-            self.cache.pop(next(iter(self.cache)))  # Eliminar el primer elemento (FIFO)
-        self.cache[key] = value
+        self._remember(key, value)
+        with self.write_lock:
+            # Acumular y escribir por lotes en lugar de una sentencia y transacción por fila
+            self.pending_writes.append((key, value[0], value[1]))
+            if len(self.pending_writes) >= self.commit_every:
+                self._write_pending()
+
+    def is_miss(self, key: str) -> bool:
+        if key in self.misses:
+            return True
+        # Los fallos de ejecuciones anteriores caducan pasado miss_ttl
+        row = self._reader().execute(
+            "SELECT 1 FROM misses WHERE query = ? AND ts > ?",
+            (key, int(time.time()) - self.miss_ttl)
+        ).fetchone()
+        if row:
+            self.misses.add(key)
+        return row is not None
+
+    def add_miss(self, key: str):
+        self.misses.add(key)
+        with self.write_lock:
+            self.pending_misses.append((key, int(time.time())))
+            if len(self.pending_misses) >= self.commit_every:
+                self._write_pending()
+
+    def flush(self):
+        """Confirma en disco las escrituras pendientes."""
+        with self.write_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Escribe el lote pendiente en una sola transacción (requiere write_lock)."""
+        if self.pending_writes:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO locations (query, lon, lat) VALUES (?, ?, ?)",
+                self.pending_writes
+            )
+            self.pending_writes.clear()
+        if self.pending_misses:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO misses (query, ts) VALUES (?, ?)",
+                self.pending_misses
+            )
+            self.pending_misses.clear()
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            for reader in self.readers:
+                reader.close()
+            self.readers.clear()
+        self.conn.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        """Devuelve la conexión de solo lectura del hilo actual (WAL: no bloquea al escritor)."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA query_only=1")
+            self.local.conn = conn
+            with self.write_lock:
+                self.readers.append(conn)
+        return conn
+
+    def _remember(self, key: str, value: Tuple[float, float]):
+        with self.mem_lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)  # Eliminar el menos usado recientemente (LRU)
 
 geo_cache = GeoCache()
 
@@ -105,26 +240,55 @@ geolocator = Nominatim(
     user_agent=GEOLOCATION_CONFIG['nominatim']['user_agent'],
     timeout=GEOLOCATION_CONFIG['nominatim']['timeout']
 )
-geocode = RateLimiter(geolocator.geocode, min_delay_seconds=GEOLOCATION_CONFIG['nominatim']['rate_limit'])
+# RateLimiter es seguro entre hilos: todos los workers comparten el límite de Nominatim
+geocode = RateLimiter(
+    geolocator.geocode,
+    min_delay_seconds=GEOLOCATION_CONFIG['nominatim']['rate_limit'],
+    swallow_exceptions=False
+)
+
+# Consultas en curso: si otro hilo ya geocodifica el mismo texto, se espera su resultado
+_inflight_geocodes = {}
+_inflight_lock = threading.Lock()
 
 def enhanced_geocode(location_text: str) -> Optional[Tuple[float, float]]:
     """Realiza la geocodificación utilizando un sistema de caché."""
     if not location_text:
         return None
     
+    # Clave normalizada: "Paris", "PARIS" o " paris " comparten entrada en la caché
+    key = " ".join(location_text.split()).lower()
+
     # Verificar en caché
-    cached = geo_cache.get(location_text)
+    cached = geo_cache.get(key)
     if cached:
         return cached
+    if geo_cache.is_miss(key):
+        return None
+
+    with _inflight_lock:
+        event = _inflight_geocodes.get(key)
+        is_owner = event is None
+        if is_owner:
+            event = _inflight_geocodes[key] = threading.Event()
+    if not is_owner:
+        event.wait()
+        return geo_cache.get(key)
     
     try:
-        location = geolocator.geocode(location_text)
+        location = geocode(location_text)
         if location and is_valid_coords(location.longitude, location.latitude):
             coords = (location.longitude, location.latitude)
-            geo_cache.set(location_text, coords)
+            geo_cache.set(key, coords)
             return coords
+        # Sin resultado: no volver a consultarlo hasta que caduque (GEOCACHE_MISS_TTL)
+        geo_cache.add_miss(key)
     except Exception as e:
         logger.error(f"Error en geocodificación: {str(e)[:200]}")
+    finally:
+        with _inflight_lock:
+            del _inflight_geocodes[key]
+        event.set()
     
     return None
 
@@ -136,6 +300,10 @@ def is_valid_coords(lon: float, lat: float) -> bool:
 # ==================== FUNCIONES DE EXTRACCIÓN DE UBICACIONES ==============
 ############################################################################
 
+def strip_html(text: str) -> str:
+    """Elimina etiquetas HTML; omite el regex si el texto no contiene '<'."""
+    return HTML_TAG_REGEX.sub('', text) if '<' in text else text
+
 def metadata_location(entry) -> Optional[Tuple[float, float]]:
     """Busca ubicación en los metadatos del feed."""
     if hasattr(entry, 'geo_lat') and hasattr(entry, 'geo_long'):
@@ -150,8 +318,9 @@ def metadata_location(entry) -> Optional[Tuple[float, float]]:
 
 def content_location(entry) -> Optional[Tuple[float, float]]:
     """Busca menciones de ubicaciones en el contenido del título y resumen."""
-    clean_content = re.sub('<[^>]+>', '', f"{entry.title} {entry.summary}")
-    for loc in LOCATION_REGEX.findall(clean_content):
+    clean_content = strip_html(f"{entry.title} {entry.summary}")
+    # dict.fromkeys elimina candidatos repetidos conservando el orden
+    for loc in dict.fromkeys(LOCATION_REGEX.findall(clean_content)):
         coords = enhanced_geocode(loc)
         if coords:
             return coords
@@ -163,31 +332,41 @@ def content_location(entry) -> Optional[Tuple[float, float]]:
 
 def detect_emotions(text: str) -> dict:
     """Detecta emociones en el texto utilizando NLP."""
-    if not text.strip():
-        return {"joy": 0, "sadness": 0, "surprise": 0, "fear": 0}
-    
-    emotions = emotion_classifier(text)
-    if not emotions or len(emotions) == 0:
-        return {"joy": 0, "sadness": 0, "surprise": 0, "fear": 0}
-
-    emotion_scores = {emotion["label"].lower(): round(emotion["score"], 2) for emotion in emotions[0]}
-    return {
-        "joy": emotion_scores.get("joy", 0),
-        "sadness": emotion_scores.get("sadness", 0),
-        "surprise": emotion_scores.get("surprise", 0),
-        "fear": emotion_scores.get("fear", 0)
-    }
-
-def process_feed_entry(entry) -> Optional[Feature]:
+    return detect_emotions_batch([text])[0]
+
+def detect_emotions_batch(texts: List[str]) -> List[dict]:
+    """Detecta emociones en varios textos con una sola llamada al modelo."""
+    results = [dict.fromkeys(EMOTION_LABELS, 0) for _ in texts]
+    pending = [i for i, text in enumerate(texts) if text.strip()]
+    if not pending:
+        return results
+
+    # El pipeline agrupa los textos en lotes y amortiza el coste de cada pasada
+    outputs = emotion_classifier(
+        [texts[i] for i in pending],
+        batch_size=EMOTION_BATCH_SIZE,
+        truncation=True
+    )
+    for i, emotions in zip(pending, outputs or []):
+        # Una sola pasada: solo se redondean las etiquetas que se publican
+        scores = results[i]
+        for emotion in emotions:
+            label = emotion["label"].lower()
+            if label in scores:
+                scores[label] = round(emotion["score"], 2)
+    return results
+
+def process_feed_entry(entry, emotions: Optional[dict] = None) -> Optional[Feature]:
     """Procesa una entrada RSS y crea una Feature de GeoJSON."""
     try:
         title = entry.get('title', 'Sin título').strip()
         link = entry.get('link', '')
         published = entry.get('published', '')
-        summary = re.sub('<[^>]+>', '', entry.get('summary', ''))
+        summary = strip_html(entry.get('summary', ''))
 
-        # Detección de emociones
-        emotions = detect_emotions(summary)
+        # Detección de emociones (si no se calcularon ya para todo el feed)
+        if emotions is None:
+            emotions = detect_emotions(summary)
 
         # Estrategia de geocodificación múltiple
         coords = metadata_location(entry) or content_location(entry)
@@ -195,7 +374,7 @@ def process_feed_entry(entry) -> Optional[Feature]:
         properties = {
             'title': title,
             'link': link,
-            'published': format_date(published),
+            'published': format_date(published, entry.get('published_parsed')),
             'description': summary[:500] + '...' if len(summary) > 500 else summary,
             'emotions': emotions,
             'author': entry.get('author', 'Desconocido'),
@@ -207,8 +386,11 @@ def process_feed_entry(entry) -> Optional[Feature]:
         logger.error(f"Error procesando entrada: {str(e)[:200]}")
         return None
 
-def format_date(date_str: str) -> str:
+def format_date(date_str: str, parsed: Optional[time.struct_time] = None) -> str:
     """Formatea la fecha publicada en un formato legible."""
+    # feedparser ya entrega la fecha normalizada a UTC: evita volver a analizar el texto
+    if parsed:
+        return time.strftime("%Y-%m-%d %H:%M UTC", parsed)
     try:
         dt = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
         return dt.strftime("%Y-%m-%d %H:%M UTC")
@@ -224,8 +406,8 @@ def merge_geojson_data(new_data: FeatureCollection) -> None:
 
     if os.path.exists(OUTPUT_FILE):
         try:
-            with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
-                existing_data_json = json.load(f)
+            with open(OUTPUT_FILE, 'rb') as f:
+                existing_data_json = orjson.loads(f.read())
                 valid_features = [
                     f for f in existing_data_json.get("features", [])
                     if isinstance(f, dict) and isinstance(f.get("properties", {}), dict)
@@ -245,35 +427,116 @@ def merge_geojson_data(new_data: FeatureCollection) -> None:
         if isinstance(f, dict) and f.get("properties", {}).get('link') not in existing_ids
     ]
 
-    updated_features = existing_data.get("features", []) + new_features
-
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(FeatureCollection(updated_features), f, ensure_ascii=False, indent=2)
+    write_feature_collection(OUTPUT_FILE, chain(existing_data.get("features", []), new_features))
+
+def write_feature_collection(path: str, features: Iterable[dict]) -> None:
+    """Escribe una FeatureCollection en streaming con orjson, una Feature por línea."""
+    # Temporal + reemplazo atómico: un fallo a mitad de escritura conserva el archivo anterior
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(b'{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(features):
+            if i:
+                f.write(b',\n')
+            f.write(orjson.dumps(feature))
+        f.write(b'\n]}\n')
+    os.replace(temp_path, path)
 
 ############################################################################
 # ====================== EJECUCIÓN PRINCIPAL ===============================
 ############################################################################
 
+# Enlaces ya reclamados en esta ejecución: varios feeds comparten las mismas alertas
+_seen_links = set()
+_seen_links_lock = threading.Lock()
+
+def claim_new_entries(entries: list) -> list:
+    """Devuelve las entradas cuyo enlace no ha sido procesado ya por otro feed."""
+    fresh = []
+    with _seen_links_lock:
+        for e in entries:
+            link = e.get('link', '')
+            if link:
+                if link in _seen_links:
+                    continue
+                _seen_links.add(link)
+            fresh.append(e)
+    return fresh
+
+def load_feed_state() -> dict:
+    """Carga los validadores HTTP guardados en la ejecución anterior."""
+    try:
+        with open(FEED_STATE_FILE, 'rb') as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+def save_feed_state(state: dict) -> None:
+    # Temporal + reemplazo atómico, como write_feature_collection
+    temp_path = f"{FEED_STATE_FILE}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+    os.replace(temp_path, FEED_STATE_FILE)
+
+feed_state = load_feed_state()
+
 def process_feed(feed_url: str) -> List[Feature]:
-    response = requests.get(feed_url, timeout=15)
+    # GET condicional: si el feed no cambió el servidor responde 304 sin cuerpo
+    validators = feed_state.get(feed_url, {})
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    response = session.get(feed_url, headers=headers, timeout=15)
+    if response.status_code == 304:
+        return []
     response.raise_for_status()
+    new_validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
     feed = feedparser.parse(response.content)
-    return [entry for e in feed.entries if (entry := process_feed_entry(e))]
+    entries = claim_new_entries(feed.entries)
+
+    # Clasificar las emociones de todo el feed en lote en lugar de entrada por entrada
+    summaries = [strip_html(e.get('summary', '')) for e in entries]
+    try:
+        emotions = detect_emotions_batch(summaries)
+    except Exception as e:
+        logger.error(f"Error detectando emociones del feed: {str(e)[:200]}")
+        emotions = [None] * len(entries)
+
+    features = [
+        entry for e, emo in zip(entries, emotions)
+        if (entry := process_feed_entry(e, emo))
+    ]
+    # Se guarda solo si todas las entradas dieron una Feature: con una descartada, el
+    # siguiente 304 impediría volver a intentarla mientras el feed no cambie
+    if len(features) == len(entries):
+        feed_state[feed_url] = new_validators
+    else:
+        logger.warning(f"{len(entries) - len(features)} entradas omitidas; se reintentará el feed {feed_url}")
+    return features
 
 def main():
     logger.info("Iniciando recopilación de alertas masónicas")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = {executor.submit(process_feed, url): url for url in RSS_FEEDS}
-        results = []
-
-        for future in as_completed(futures):
-            try:
-                results.extend(future.result())
-            except Exception as e:
-                logger.error(f"Error en feed: {str(e)[:200]}")
+    try:
+        with ThreadPoolExecutor(max_workers=FEED_WORKERS, thread_name_prefix="feed") as executor:
+            futures = {executor.submit(process_feed, url): url for url in RSS_FEEDS}
+            results = []
+
+            for future in as_completed(futures):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    logger.error(f"Error en feed: {str(e)[:200]}")
+    finally:
+        geo_cache.close()
 
     merge_geojson_data(FeatureCollection(results))
+    save_feed_state(feed_state)
     logger.info(f"Proceso completado. Datos guardados en {OUTPUT_FILE}")
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import sys
-import json
 import logging
-from geojson import FeatureCollection, load, dump
+import orjson
+from geojson import FeatureCollection, load
 
 # Configuración de logging
 logging.basicConfig(
@@ -37,8 +37,14 @@ def combine_geojson(existing_path: str, new_path: str, output_path: str) -> None
         temp_path = f"{output_path}.tmp"
         combined = FeatureCollection(existing["features"] + unique_new)
         
-        with open(temp_path, "w", encoding="utf-8") as f:
-            dump(combined, f, indent=2, ensure_ascii=False)
+        # Sin sangría: una Feature compacta por línea, como el resto de salidas del proyecto
+        with open(temp_path, "wb") as f:
+            f.write(b'{"type": "FeatureCollection", "features": [\n')
+            for i, feature in enumerate(combined["features"]):
+                if i:
+                    f.write(b",\n")
+                f.write(orjson.dumps(feature))
+            f.write(b"\n]}\n")
 
         # Reemplazar archivo original de forma segura
         import os
@@ -1,17 +1,20 @@
-import json
-from geojson import Feature, FeatureCollection, Point, dump
+import orjson
+from geojson import Feature, FeatureCollection, Point
 from geopy.geocoders import Nominatim
+from geopy.extra.rate_limiter import RateLimiter
 
 # Configuración del geolocalizador (ajusta el user_agent según tu proyecto)
 geolocator = Nominatim(user_agent="my_wiki_geocoder")
+# Nominatim admite como máximo una petición por segundo
+geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1, swallow_exceptions=False)
 
 def load_wikipedia_data():
     """
     Carga el contenido de wikipedia_data.json y devuelve una lista de entradas.
     Si el JSON tiene la clave "features", se extrae esa lista.
     """
-    with open("wikipedia_data.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open("wikipedia_data.json", "rb") as f:
+        data = orjson.loads(f.read())
     if isinstance(data, dict) and "features" in data:
         return data["features"]
     elif isinstance(data, list):
@@ -27,7 +30,7 @@ def geocode_location(place_name):
     if not place_name:
         return None, None
     try:
-        location = geolocator.geocode(place_name, timeout=10)
+        location = geocode(place_name, timeout=10)
         if location:
             return (location.latitude, location.longitude)
     except Exception as e:
@@ -48,6 +51,15 @@ def create_geojson_from_wikipedia(data):
             print(f"Entrada inválida (no es dict): {entry}")
             continue
 
+        # Las entradas con forma de Feature (wikipedia_scraper.py) traen los datos en
+        # "properties" y, si el artículo las tiene, las coordenadas ya resueltas
+        properties = entry.get("properties")
+        if isinstance(properties, dict):
+            coordinates = (entry.get("geometry") or {}).get("coordinates") or []
+            entry = dict(properties)
+            if len(coordinates) == 2:
+                entry["longitude"], entry["latitude"] = coordinates
+
         # Usar "summary" o, de no existir, "description" como respaldo
         summary = entry.get("summary", entry.get("description", ""))
         if not summary:
@@ -81,6 +93,11 @@ def create_geojson_from_wikipedia(data):
             "keyword": entry.get("keyword", ""),
             "raw_location": entry.get("location", "")
         }
+        # Conservar los datos del scraper: wikipedia_scraper.py reconoce por 'url' (e
+        # idioma/título) los artículos ya guardados en este archivo
+        for key in ("url", "description", "image", "language"):
+            if key in entry:
+                properties[key] = entry[key]
 
         features.append(Feature(geometry=geometry, properties=properties))
 
@@ -95,8 +112,8 @@ def main():
 
     fc = create_geojson_from_wikipedia(data)
 
-    with open("wikipedia_data.geojson", "w", encoding="utf-8") as f:
-        dump(fc, f, ensure_ascii=False, indent=2)
+    with open("wikipedia_data.geojson", "wb") as f:
+        f.write(orjson.dumps(fc, option=orjson.OPT_INDENT_2))
 
     print("✅ Generado wikipedia_data.geojson con uso de lat/lon, geocodificación y fallback.")
 
@@ -8,12 +8,14 @@ clasificación temática y resúmenes largos con Hugging Face.
 
 import sys
 import os
-import json
+import re
+import orjson
 from datetime import datetime
+from functools import lru_cache
 from textblob import TextBlob
 from langdetect import detect, DetectorFactory
-from urllib.parse import urlparse
 from geopy.geocoders import Nominatim
+from geopy.extra.rate_limiter import RateLimiter
 import tldextract
 from transformers import pipeline
 
@@ -21,9 +23,12 @@ DetectorFactory.seed = 0  # Para resultados consistentes en detección de idioma
 
 # Configurar geolocalización
 geolocator = Nominatim(user_agent="masonic_analysis_geolocator")
+# Nominatim admite como máximo una petición por segundo
+reverse = RateLimiter(geolocator.reverse, min_delay_seconds=1, swallow_exceptions=False)
 
 # Inicializar pipeline de resúmenes (modelo BART preentrenado)
 summarizer = pipeline("summarization", model="facebook/bart-large-cnn")
+SUMMARY_BATCH_SIZE = 8  # Textos por pasada del modelo de resúmenes
 
 # ========== Diccionario de categorías optimizadas ==========
 CATEGORIES = {
@@ -71,14 +76,22 @@ CATEGORIES = {
     ]
 }
 
+# Una alternancia precompilada por categoría: el texto se recorre una vez por categoría
+# en lugar de una vez por palabra clave
+CATEGORY_PATTERNS = {
+    category: re.compile("|".join(re.escape(keyword.lower()) for keyword in keywords))
+    for category, keywords in CATEGORIES.items()
+}
+
 # ========== Función para geolocalización avanzada ==========
+@lru_cache(maxsize=None)  # Muchas características comparten coordenadas: una consulta por punto
 def get_location_details(coords):
     """
     Intenta obtener información detallada de localización (municipio, país, etc.)
     a partir de coords en formato (lat, lon) para geopy.
     """
     try:
-        location = geolocator.reverse(coords, exactly_one=True, timeout=10)
+        location = reverse(coords, exactly_one=True, timeout=10)
         if location and location.raw.get("address"):
             address = location.raw["address"]
             return {
@@ -104,7 +117,6 @@ def get_source_from_url(url):
     """
     Extrae el nombre de dominio principal a partir de la URL.
     """
-    parsed_url = urlparse(url)
     domain = tldextract.extract(url).domain
     return domain.capitalize() if domain else "Fuente desconocida"
 
@@ -157,34 +169,54 @@ def categorize_text(text):
     """
     Asigna al texto una o varias categorías en base a palabras clave definidas en CATEGORIES.
     """
-    found_categories = []
-    for main_category, keywords in CATEGORIES.items():
-        if any(keyword.lower() in text.lower() for keyword in keywords):
-            found_categories.append(main_category)
+    text_lower = text.lower()
+    found_categories = [
+        main_category for main_category, pattern in CATEGORY_PATTERNS.items()
+        if pattern.search(text_lower)
+    ]
     return ", ".join(found_categories) if found_categories else "sin categoría"
 
 # ========== Generar resumen largo utilizando BART ==========
-def generate_long_summary(text):
+def summarize_texts(texts):
     """
-    Genera un resumen usando el modelo BART. 
-    - Omite el resumen si el texto es muy corto (< 200 caracteres).
+    Pasa los textos juntos por el modelo BART (en lotes de SUMMARY_BATCH_SIZE).
     - max_length reducido a 120 para acelerar el proceso y evitar timeouts.
     """
+    outputs = summarizer(
+        texts,
+        batch_size=SUMMARY_BATCH_SIZE,
+        truncation=True,
+        max_length=120,  # Reducir para que el pipeline sea más rápido
+        min_length=60,   # Ajusta según la extensión que quieras
+        do_sample=False
+    )
+    return [output["summary_text"] for output in outputs]
+
+def generate_long_summaries(texts):
+    """
+    Genera los resúmenes de varios textos por lotes usando el modelo BART.
+    - Omite el resumen si el texto es muy corto (< 200 caracteres).
+    - Si un lote falla se reintenta texto a texto, y solo el texto que siga
+      fallando se sustituye por sus primeros 500 caracteres.
+    """
+    summaries = list(texts)
     # Evitar resumen si texto muy corto
-    if len(text) < 200:
-        return text
+    pending = [i for i, text in enumerate(texts) if len(text) >= 200]
 
-    try:
-        summarized_text = summarizer(
-            text,
-            max_length=120,  # Reducir para que el pipeline sea más rápido
-            min_length=60,   # Ajusta según la extensión que quieras
-            do_sample=False
-        )[0]["summary_text"]
-        return summarized_text
-    except Exception as e:
-        print(f"Error al generar resumen: {str(e)}")
-        return text[:500]
+    for start in range(0, len(pending), SUMMARY_BATCH_SIZE):
+        batch = pending[start:start + SUMMARY_BATCH_SIZE]
+        try:
+            for i, summary in zip(batch, summarize_texts([texts[i] for i in batch])):
+                summaries[i] = summary
+        except Exception as e:
+            print(f"Error al generar resúmenes por lotes, reintentando uno a uno: {str(e)}")
+            for i in batch:
+                try:
+                    summaries[i] = summarize_texts([texts[i]])[0]
+                except Exception as e:
+                    print(f"Error al generar resumen: {str(e)}")
+                    summaries[i] = texts[i][:500]
+    return summaries
 
 # ========== Función principal (con manejo de parámetros de línea de comandos) ==========
 def main():
@@ -214,14 +246,21 @@ def main():
         return
 
     # Cargar el GeoJSON
-    with open(input_file, "r", encoding="utf-8") as f:
-        geojson_data = json.load(f)
+    with open(input_file, "rb") as f:
+        geojson_data = orjson.loads(f.read())
 
     references = []
     analysis_results = []
 
+    features = geojson_data.get("features", [])
+
+    # Resúmenes extensos de todas las características en lotes usando BART
+    long_summaries = generate_long_summaries(
+        [feature.get("properties", {}).get("summary", "") for feature in features]
+    )
+
     # Procesar cada característica en el GeoJSON
-    for feature in geojson_data.get("features", []):
+    for feature, long_summary in zip(features, long_summaries):
         properties = feature.get("properties", {})
         title = properties.get("title", "Sin título").strip()
         description = properties.get("summary", "")  # O 'description' si fuese la key
@@ -234,8 +273,7 @@ def main():
         reference = generate_apa_reference(properties)
         references.append(reference)
 
-        # 2. Resumen extenso usando BART
-        long_summary = generate_long_summary(description)
+        # 2. Resumen extenso usando BART (ya calculado por lotes)
 
         # 3. Análisis de sentimiento
         sentiment = analyze_sentiment(description)
@@ -6,7 +6,6 @@ import requests
 from geojson import FeatureCollection, Feature, Point
 from bs4 import BeautifulSoup
 from langdetect import detect, LangDetectException
-from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.service_account import Credentials
 from urllib.parse import urlparse
 from requests.adapters import HTTPAdapter
@@ -21,6 +20,9 @@ def get_session():
     session.mount('https://', adapter)
     return session
 
+# Sesión compartida: las conexiones se reutilizan entre URLs en lugar de abrir una por alerta
+session = get_session()
+
 def read_google_sheets():
     """Lee y devuelve los datos del Google Sheet."""
     creds = Credentials.from_service_account_info(json.loads(os.environ["GOOGLE_CREDENTIALS"]))
@@ -32,7 +34,6 @@ def read_google_sheets():
 
 def scrape_alert(url):
     """Procesa una URL y extrae datos usando BeautifulSoup."""
-    session = get_session()
     try:
         response = session.get(url.strip(), timeout=15)
         response.raise_for_status()
@@ -1,28 +1,76 @@
 import os
-import json
+import re
+import shutil
+import time
+import orjson
 import requests
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-from datetime import datetime
+from itertools import chain
+from datetime import datetime, timezone
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+# Hilos concurrentes: el trabajo es solo E/S de red repartida entre varios hosts de Wikipedia
+MAX_WORKERS = int(os.environ.get("WIKI_WORKERS", 10))
+
 # Configuración de sesión con reintentos para requests
 session = requests.Session()
 retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-adapter = HTTPAdapter(max_retries=retries)
+# Una conexión por hilo y host para que ningún hilo espere a que se libere otra
+adapter = HTTPAdapter(max_retries=retries, pool_maxsize=MAX_WORKERS)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
-
-# Configuración inicial de geolocalización
-geolocator = Nominatim(user_agent="m357_map_v1", timeout=20)
-geocode = RateLimiter(geolocator.geocode, min_delay_seconds=2)
+# Wikimedia limita a los clientes con el User-Agent genérico de requests
+session.headers["User-Agent"] = "m357_map_v1 (https://github.com/KnowmadInstitut/m357map)"
 
 BATCH_SIZE = 100  # Entradas por lote
+DETAILS_BATCH_SIZE = 50  # Títulos por consulta de detalles (máximo de la API; los extractos siguen con "continue")
 PROGRESS_FILE = "progress.txt"
 WIKIPEDIA_JSON = "wikipedia_data.json"
 GEOJSON_OUTPUT = "wikipedia_data.geojson"
+LANGUAGES = ["en", "es", "fr", "de", "pt"]  # Idiomas a buscar
+
+# Endpoints y parámetros fijos precalculados: cada llamada solo añade lo que varía
+API_URLS = {lang: f"https://{lang}.wikipedia.org/w/api.php" for lang in LANGUAGES}
+ARTICLE_URLS = {lang: f"https://{lang}.wikipedia.org/wiki/" for lang in LANGUAGES}
+# Espacios a '_' y escape solo de los caracteres que romperían la URL; el resto del
+# título (acentos, otros alfabetos) se conserva igual que en las URLs ya guardadas
+TITLE_URL_TABLE = str.maketrans({" ": "_", "%": "%25", "?": "%3F", "#": "%23"})
+SEARCH_PARAMS = {
+    "action": "query",
+    "format": "json",
+    "list": "search",
+    "srlimit": 50,  # Máximo por consulta
+    "maxlag": 5  # La API rechaza la consulta si las réplicas van retrasadas
+}
+SEARCH_MAX_PAGES = 3  # Páginas de resultados como máximo por término e idioma
+MAXLAG_ATTEMPTS = 3  # Intentos por consulta rechazada por maxlag
+DETAILS_PARAMS = {
+    "action": "query",
+    "format": "json",
+    "prop": "extracts|coordinates|pageimages",
+    "exintro": True,
+    "explaintext": True,
+    "exlimit": "max",
+    "colimit": "max",
+    "pilimit": "max",
+    "pithumbsize": 500,  # Imagen de previsualización
+    "maxlag": 5
+}
+
+# Raíces masónicas en los idiomas buscados: descarta resultados ajenos antes de pedir detalles.
+# Las raíces cortas van delimitadas ("rite" no debe aceptar "Writer" ni "loge" "Biologe");
+# las largas no, para que compuestos como "Francmasonería" sigan coincidiendo. Los
+# compuestos alemanes de "Loge" se enumeran (IGNORECASE no iguala "ß" con "ss")
+RELEVANT_REGEX = re.compile(
+    r"mas[oó]n|ma[çc][oô]n|maçom|massoner|massoni|freimaur|maurerei|масон|"
+    r"\btempl(?:ar|er|ier|ario|ário)|tempelritter|"
+    r"\blodges?\b|\blogias?\b|\b(?:gro(?:ß|ss))?loge[ns]?(?:haus)?\b|\blojas?\b|\bloggi[ae]\b|"
+    r"\brit(?:e|o|us)s?\b|gran(?:de?)? orient|gro(?:ß|ss)orient",
+    re.IGNORECASE
+)
+# Los extractos de búsqueda marcan las coincidencias con <span class="searchmatch">
+SNIPPET_TAG_REGEX = re.compile(r"<[^>]+>")
 
 # Lista completa de términos de búsqueda
 SEARCH_TERMS = [
@@ -222,6 +270,8 @@ SEARCH_TERMS = [
     "Antimasonería", "Anti-Freemasonry", "Antimaçonaria", "Antimaisonnerie",
     "Антимасонство", "反共氏会", "Masonluk karşıtı"
 ]
+# Varias categorías repiten términos: cada uno se busca una sola vez, conservando el orden
+SEARCH_TERMS = list(dict.fromkeys(SEARCH_TERMS))
 
 def load_progress():
     if os.path.exists(PROGRESS_FILE):
@@ -233,52 +283,80 @@ def save_progress(current_index):
     with open(PROGRESS_FILE, "w") as f:
         f.write(str(current_index))
 
-def search_wikipedia(term, lang="en"):
-    """Realiza una búsqueda en Wikipedia y devuelve las entradas relevantes."""
-    url = f"https://{lang}.wikipedia.org/w/api.php"
-    params = {
-        "action": "query",
-        "format": "json",
-        "list": "search",
-        "srsearch": term,
-        "srlimit": 50  # Máximo por consulta
-    }
-    try:
-        response = session.get(url, params=params, timeout=10)
+def query_api(lang, params, timeout):
+    """Consulta la API de Wikipedia; si responde con maxlag espera lo indicado y reintenta."""
+    for _ in range(MAXLAG_ATTEMPTS):
+        response = session.get(API_URLS[lang], params=params, timeout=timeout)
         response.raise_for_status()
-        return response.json().get("query", {}).get("search", [])
-    except requests.RequestException as e:
-        print(f"Error en la búsqueda de Wikipedia para el término '{term}': {e}")
-        return []
-
-def get_article_details(title, lang="en"):
-    """Obtiene detalles del artículo dado un título."""
-    url = f"https://{lang}.wikipedia.org/w/api.php"
-    params = {
-        "action": "query",
-        "format": "json",
-        "prop": "extracts|coordinates|pageimages",
-        "exintro": True,
-        "explaintext": True,
-        "titles": title,
-        "pithumbsize": 500  # Imagen de previsualización
-    }
-    try:
-        response = session.get(url, params=params, timeout=20)
-        response.raise_for_status()
-        pages = response.json().get("query", {}).get("pages", {})
-        for page_id, page in pages.items():
-            if page.get("title"):
-                return {
-                    "title": page.get("title"),
-                    "url": f"https://{lang}.wikipedia.org/wiki/{page.get('title').replace(' ', '_')}",
-                    "description": page.get("extract", ""),
-                    "coordinates": page.get("coordinates", [{}])[0],
-                    "image": page.get("thumbnail", {}).get("source")
-                }
-    except requests.RequestException as e:
-        print(f"Error al obtener detalles del artículo '{title}': {e}")
-        return {}
+        data = orjson.loads(response.content)
+        if data.get("error", {}).get("code") != "maxlag":
+            return data
+        time.sleep(int(response.headers.get("Retry-After", 5)))
+    raise requests.RequestException(f"Wikipedia '{lang}' sigue con maxlag tras {MAXLAG_ATTEMPTS} intentos")
+
+def search_wikipedia(term, lang="en"):
+    """Realiza una búsqueda en Wikipedia y devuelve las entradas relevantes.
+
+    Los errores 429/5xx ya se reintentan con espera exponencial en la sesión; si aun así
+    falla, la excepción se propaga para que el término no se dé por completado.
+    """
+    params = {**SEARCH_PARAMS, "srsearch": term}
+    results = []
+    for _ in range(SEARCH_MAX_PAGES):
+        data = query_api(lang, params, timeout=10)
+        page = data.get("query", {}).get("search", [])
+        results.extend(page)
+        # Solo se pide la página siguiente (sroffset) si esta fue mayoritariamente relevante
+        relevant = sum(1 for article in page if is_relevant(article, term))
+        if "continue" not in data or relevant * 2 < len(page):
+            break
+        params = {**params, **data["continue"]}
+    return results
+
+def is_relevant(article, term):
+    """Indica si un resultado de búsqueda merece pedir sus detalles."""
+    title = article.get("title", "")
+    # Los términos propios (personas, documentos) se aceptan si aparecen en el título
+    if term.casefold() in title.casefold():
+        return True
+    snippet = SNIPPET_TAG_REGEX.sub("", article.get("snippet", ""))
+    return bool(RELEVANT_REGEX.search(title) or RELEVANT_REGEX.search(snippet))
+
+def article_url(title, lang):
+    """URL canónica de un artículo, la misma que se guarda en 'properties.url'."""
+    return ARTICLE_URLS[lang] + title.translate(TITLE_URL_TABLE)
+
+def get_articles_details(titles, lang="en"):
+    """Obtiene los detalles de varios artículos agrupando los títulos en una consulta por lote."""
+    details = {}
+    for start in range(0, len(titles), DETAILS_BATCH_SIZE):
+        chunk = titles[start:start + DETAILS_BATCH_SIZE]
+        params = {**DETAILS_PARAMS, "titles": "|".join(chunk)}
+        try:
+            pages = {}
+            while True:
+                data = query_api(lang, params, timeout=20)
+                # Cada continuación completa los extractos/coordenadas/imágenes que faltaban
+                for page_id, page in data.get("query", {}).get("pages", {}).items():
+                    merged = pages.setdefault(page_id, {})
+                    for key, value in page.items():
+                        merged.setdefault(key, value)
+                if "continue" not in data:
+                    break
+                params = {**params, **data["continue"]}
+            for page in pages.values():
+                if page.get("title"):
+                    details[page["title"]] = {
+                        "title": page.get("title"),
+                        "url": article_url(page["title"], lang),
+                        "description": page.get("extract", ""),
+                        "coordinates": page.get("coordinates", [{}])[0],
+                        "image": page.get("thumbnail", {}).get("source")
+                    }
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            print(f"Error al obtener detalles de {len(chunk)} artículos en '{lang}': {e}")
+            raise  # Sin detalles completos el término no debe contarse como procesado
+    return details
 
 def geocode_location(coordinates):
     """Convierte las coordenadas de Wikipedia en formato de lat/lon para GeoJSON."""
@@ -292,95 +370,159 @@ def geocode_location(coordinates):
         pass
     return None
 
-def process_entries(entries, lang="en"):
+def process_entries(entries, lang="en", timestamp=None):
     """Procesa un lote de artículos de Wikipedia."""
+    # Marca de tiempo de la ejecución: se calcula una vez, no por cada Feature
+    timestamp = timestamp or datetime.now(timezone.utc).isoformat()
     results = []
-    for entry in entries:
-        details = get_article_details(entry["title"], lang)
+    details_by_title = get_articles_details([entry["title"] for entry in entries], lang)
+    for details in details_by_title.values():
+        # Cada campo se lee una sola vez del diccionario de detalles
+        title, url = details.get("title"), details.get("url")
         # Solo procesar si se obtuvieron 'title' y 'url'
-        if details and details.get("title") and details.get("url"):
-            coordinates = geocode_location(details.get("coordinates"))
-            results.append({
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point" if coordinates else None,
-                    "coordinates": coordinates if coordinates else []
-                },
-                "properties": {
-                    "title": details["title"],
-                    "url": details["url"],
-                    "description": details.get("description", ""),
-                    "image": details.get("image"),
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "language": lang
-                }
-            })
+        if not (title and url):
+            continue
+        coordinates = geocode_location(details.get("coordinates"))
+        results.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Point" if coordinates else None,
+                "coordinates": coordinates or []
+            },
+            "properties": {
+                "title": title,
+                "url": url,
+                "description": details.get("description", ""),
+                "image": details.get("image"),
+                "timestamp": timestamp,
+                "language": lang
+            }
+        })
     return results
 
-def merge_and_save_geojson(new_features):
-    """Combina los resultados nuevos con los existentes y guarda el GeoJSON."""
-    existing_data = []
+def load_existing_features():
+    """Carga las Features ya guardadas en el GeoJSON de salida."""
     if os.path.exists(GEOJSON_OUTPUT):
         try:
-            with open(GEOJSON_OUTPUT, "r") as f:
-                existing_data = json.load(f).get("features", [])
-        except (json.JSONDecodeError, FileNotFoundError) as e:
+            with open(GEOJSON_OUTPUT, "rb") as f:
+                return orjson.loads(f.read()).get("features", [])
+        except (orjson.JSONDecodeError, FileNotFoundError) as e:
             print(f"Error al cargar el archivo GeoJSON existente: {e}")
+    return []
 
-    # Se filtran duplicados comprobando que existan las claves 'url' y 'title'
-    existing_urls_titles = {
-        (feature.get("properties", {}).get("url"), feature.get("properties", {}).get("title"))
-        for feature in existing_data
-        if feature.get("properties", {}).get("url") and feature.get("properties", {}).get("title")
-    }
-    
-    new_features = [
-        f for f in new_features
-        if f["properties"].get("url") and f["properties"].get("title")
-           and (f["properties"]["url"], f["properties"]["title"]) not in existing_urls_titles
-    ]
+def merge_and_save_geojson(new_features, existing_data):
+    """Combina los resultados nuevos con los existentes y guarda el GeoJSON."""
+
+    # Se filtran duplicados comprobando que existan las claves 'url' y 'title'; el mismo
+    # conjunto descarta también las repeticiones dentro del lote nuevo
+    seen = set()
+    for feature in existing_data:
+        properties = feature.get("properties", {})
+        if properties.get("url") and properties.get("title"):
+            seen.add((properties["url"], properties["title"]))
+
+    unique_features = []
+    for feature in new_features:
+        properties = feature["properties"]
+        key = (properties.get("url"), properties.get("title"))
+        if key[0] and key[1] and key not in seen:
+            seen.add(key)
+            unique_features.append(feature)
+    new_features = unique_features
 
     if not new_features:
         print("No hay nuevos datos para guardar.")
         return
 
-    combined_features = existing_data + new_features
-    geojson_data = {
-        "type": "FeatureCollection",
-        "features": combined_features
-    }
-    with open(GEOJSON_OUTPUT, "w") as f:
-        json.dump(geojson_data, f, ensure_ascii=False, indent=2)
+    write_feature_collection(GEOJSON_OUTPUT, chain(existing_data, new_features))
 
-    # Actualizar también el archivo JSON secundario
-    with open(WIKIPEDIA_JSON, "w") as f:
-        json.dump({"features": combined_features}, f, ensure_ascii=False, indent=2)
+    # El archivo JSON secundario lleva el mismo contenido: se copian los bytes en lugar
+    # de serializar todo otra vez. No se usa un enlace duro porque
+    # create_wikipedia_geojson.py reescribe GEOJSON_OUTPUT en el sitio
+    shutil.copyfile(GEOJSON_OUTPUT, f"{WIKIPEDIA_JSON}.tmp")
+    os.replace(f"{WIKIPEDIA_JSON}.tmp", WIKIPEDIA_JSON)
 
     print(f"GeoJSON actualizado: {len(new_features)} nuevas entradas agregadas.")
 
+def write_feature_collection(path, features):
+    """Escribe una FeatureCollection en streaming, una Feature por línea."""
+    # Se escribe en un temporal y se reemplaza al final: una ejecución interrumpida
+    # no deja el archivo a medias ni obliga a descargarlo todo de nuevo
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(b'{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(features):
+            if i:
+                f.write(b",\n")
+            f.write(orjson.dumps(feature))
+        f.write(b"\n]}\n")
+    os.replace(temp_path, path)
+
 def main():
     # Cargar el progreso actual (índice en la lista de términos)
     progress = load_progress()
-
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    run_timestamp = datetime.now(timezone.utc).isoformat()
+    existing_data = load_existing_features()
+    # Artículos ya guardados en ejecuciones anteriores: no se vuelven a pedir sus detalles.
+    # Se reconocen por URL o, en las entradas antiguas sin URL, por (idioma, título);
+    # las que tampoco tienen idioma quedan como (None, título) y valen para cualquiera
+    existing_urls = set()
+    existing_titles = set()
+    for feature in existing_data:
+        properties = feature.get("properties", {})
+        if properties.get("url"):
+            existing_urls.add(properties["url"])
+        elif properties.get("title"):
+            existing_titles.add((properties.get("language"), properties["title"]))
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="wiki") as executor:
         futures = {}
-        for term in SEARCH_TERMS[progress:]:
-            for lang in ["en", "es", "fr", "de", "pt"]:  # Idiomas a buscar
-                futures[executor.submit(search_wikipedia, term, lang)] = (term, lang)
+        for index in range(progress, len(SEARCH_TERMS)):
+            term = SEARCH_TERMS[index]
+            for lang in LANGUAGES:
+                futures[executor.submit(search_wikipedia, term, lang)] = (index, term, lang)
 
-        new_features = []
+        failed = set()  # Índices de términos con alguna búsqueda o detalle fallido
+
+        seen_titles = set()  # (idioma, título) ya procesados en esta ejecución
+        skipped = 0  # Resultados descartados por el filtro de relevancia
+        detail_futures = {}
         for future in as_completed(futures):
-            term, lang = futures[future]
+            index, term, lang = futures[future]
+            try:
+                # Muchos términos devuelven los mismos artículos: pedir sus detalles una sola vez
+                results = future.result()
+                articles = [a for a in results if is_relevant(a, term)]
+                skipped += len(results) - len(articles)
+                articles = [
+                    a for a in articles
+                    if (lang, a["title"]) not in seen_titles
+                    and article_url(a["title"], lang) not in existing_urls
+                    and (lang, a["title"]) not in existing_titles
+                    and (None, a["title"]) not in existing_titles
+                ]
+                seen_titles.update((lang, a["title"]) for a in articles)
+                # Los detalles se piden en el mismo pool, no en serie en el hilo principal
+                detail_futures[executor.submit(process_entries, articles, lang, run_timestamp)] = (index, term, lang)
+            except Exception as e:
+                failed.add(index)
+                print(f"Error procesando el término '{term}' en '{lang}': {e}")
+
+        print(f"Resultados descartados por irrelevantes: {skipped}")
+
+        new_features = []
+        for future in as_completed(detail_futures):
+            index, term, lang = detail_futures[future]
             try:
-                articles = future.result()
-                processed_entries = process_entries(articles, lang)
-                new_features.extend(processed_entries)
+                new_features.extend(future.result())
             except Exception as e:
+                failed.add(index)
                 print(f"Error procesando el término '{term}' en '{lang}': {e}")
 
     # Guardar los resultados en los archivos GeoJSON y JSON
-    merge_and_save_geojson(new_features)
-    save_progress(len(SEARCH_TERMS))
+    merge_and_save_geojson(new_features, existing_data)
+    # Solo avanza hasta el primer término fallido: la siguiente ejecución lo reintenta
+    save_progress(min(failed, default=len(SEARCH_TERMS)))
 
 if __name__ == "__main__":
     main()